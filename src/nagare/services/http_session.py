@@ -7,7 +7,8 @@
 # this distribution.
 # --
 
-from contextlib import contextmanager
+import sys
+from contextlib import ExitStack, nullcontext, contextmanager
 
 from nagare.session import set_session
 from nagare.services import plugin
@@ -15,19 +16,93 @@ from nagare.sessions import exceptions
 
 
 class Session(object):
-    def __init__(self, session_service, is_new, secure_token, session_id, state_id, use_same_state):
+    __slots__ = (
+        'session',
+        'secure_token',
+        'session_id',
+        'state_id',
+        'previous_state_id',
+        'use_same_state',
+        'read_only',
+        'data',
+        'is_expired',
+        'is_modified',
+        'error',
+    )
+
+    is_new = False
+
+    def __init__(self, session_service, secure_token, session_id, state_id, use_same_state, read_only=False):
         self.session = session_service
-        self.is_new = is_new
         self.secure_token = secure_token
         self.session_id = session_id
         self.state_id = self.previous_state_id = state_id
         self.use_same_state = use_same_state
+        self.read_only = read_only
 
         self.data = {}
         self.is_expired = False
+        self.is_modified = True
+        self.error = None
+
+    def delete(self):
+        self.session.delete(self.session_id)
+
+    def acquire(self):
+        """Acquire the lock of the session.
+
+        Return:
+          - the lock
+          - lock status
+          - the serialized state if already fetched, else ``None``
+        """
+        raise NotImplementedError()
+
+    def fetch(self, state=None):
+        raise NotImplementedError()
+
+    def must_be_stored(self):
+        raise NotImplementedError()
+
+    def store(self, lock=None):
+        state_id = self.previous_state_id if self.use_same_state else self.state_id
+        if lock is None:
+            self.session.store(self.session_id, state_id, self.secure_token, self.use_same_state, self.data)
+        else:
+            self.session.store_and_release(
+                lock, self.session_id, state_id, self.secure_token, self.use_same_state, self.data
+            )
+
+    @contextmanager
+    def enter(self):
+        with ExitStack() as stack:
+            try:
+                # On error, the lock is already released by ``acquire()``
+                lock, status, state = self.acquire()
+                stack.push(lock)
+
+                if not status:
+                    raise exceptions.LockError(f'Session {self.session_id}, state {self.state_id}')
+
+                data, callbacks = self.fetch(state)
+            except exceptions.InvalidSessionError as error:
+                # An invalid session is a common case, reported to the caller instead of unwinding the stack
+                data = callbacks = None
+                self.error = error
+
+            yield data, callbacks, self.error
+
+            if self.error is None:
+                if self.is_expired:
+                    self.delete()
+                elif self.must_be_stored():
+                    self.store(lock)
 
-    def get_lock(self):
-        return self.session.get_lock(self.session_id)
+
+class NewSession(Session):
+    __slots__ = ()
+
+    is_new = True
 
     def create(self):
         self.session_id, self.state_id, self.secure_token, lock = self.session.create(self.secure_token)
@@ -35,38 +110,59 @@ class Session(object):
 
         return lock
 
-    def delete(self):
-        self.session.delete(self.session_id)
+    def acquire(self):
+        lock = self.create()
+        return lock, lock.__enter__(), None
 
-    def fetch(self):
-        if self.is_new:
-            callbacks = {}
-        else:
-            new_state_id, self.secure_token, data = self.session.fetch(self.session_id, self.state_id)
-            if not self.use_same_state:
-                self.state_id, self.previous_state_id = new_state_id, self.state_id
-            self.data, callbacks = data
+    def fetch(self, state=None):
+        return self.data, {}
 
-        return self.data, callbacks
+    def must_be_stored(self):
+        return True
 
-    def store(self):
-        state_id = self.previous_state_id if self.use_same_state else self.state_id
-        self.session.store(self.session_id, state_id, self.secure_token, self.use_same_state, self.data)
 
-    @contextmanager
-    def enter(self):
-        lock = self.create() if self.is_new else self.get_lock()
+class ExistingSession(Session):
+    __slots__ = ()
+
+    def get_lock(self):
+        return self.session.get_lock(self.session_id)
 
-        with lock as status:
+    def delete(self):
+        if not self.read_only:
+            super(ExistingSession, self).delete()
+            return
+
+        # A read-only access doesn't hold the session lock, needed to delete the session
+        with self.get_lock() as status:
             if not status:
-                raise exceptions.LockError('Session {}, state {}'.format(self.session_id, self.state_id))
+                raise exceptions.LockError(f'Session {self.session_id}, state {self.state_id}')
+
+            super(ExistingSession, self).delete()
+
+    def acquire(self):
+        if self.read_only:
+            # A read-only access doesn't write the state back so it doesn't need to serialize with the other requests
+            return nullcontext(True), True, None
+
+        lock = self.get_lock()
+        status, state = self.session.lock_and_fetch(lock, self.session_id, self.state_id)
+
+        return lock, status, state
 
-            yield self.fetch()
+    def fetch(self, state=None):
+        if state is None:
+            new_state_id, self.secure_token, data = self.session.fetch(self.session_id, self.state_id)
+        else:
+            new_state_id, self.secure_token, data = self.session.deserialize(*state)
+
+        if not self.use_same_state:
+            self.state_id, self.previous_state_id = new_state_id, self.state_id
+        self.data, callbacks = data
 
-            if self.is_expired:
-                self.delete()
-            else:
-                self.store()
+        return self.data, callbacks
+
+    def must_be_stored(self):
+        return not self.read_only and (self.is_modified or not self.use_same_state)
 
 
 class SessionService(plugin.Plugin):
@@ -113,98 +209,206 @@ class SessionService(plugin.Plugin):
         self.states_history = states_history
 
         self.session_cookie = session_cookie
+        self.session_cookie_name = sys.intern(session_cookie['name'])
+        self.session_cookie_params = {k: v for k, v in session_cookie.items() if k != 'name'}
 
         if not security_cookie['samesite']:
             del security_cookie['samesite']
         self.security_cookie = security_cookie
+        self.security_cookie_name = sys.intern(security_cookie['name'])
+        self.security_cookie_params = {k: v for k, v in security_cookie.items() if k != 'name'}
+
+        self.cookie_names = tuple(name for name in (self.security_cookie_name, self.session_cookie_name) if name)
+
+        # The cookies are disabled once for all when their names are not configured
+        if not self.security_cookie_name:
+            self.set_security_cookie = self.delete_security_cookie = self.ignore_cookie
+        if not self.session_cookie_name:
+            self.set_session_cookie = self.delete_session_cookie = self.ignore_cookie
 
         self.session = session_service.service
         self.services = services_service
 
     @staticmethod
-    def get_cookie(request, name):
+    def get_cookie(request, name, cookies=None):
+        if cookies and (name in cookies):
+            return cookies[name]
+
         cookie = request.cookies.get(name)
-        return (None, None) if (cookie is None) or (':' not in cookie) else cookie.split(':')
+        if cookie is None:
+            return None, None
 
-    def get_security_cookie(self, request):
-        data, _ = self.get_cookie(request, self.security_cookie['name'])
-        return (data or '').encode('ascii')
+        i = cookie.find(':')
+        return (None, None) if i < 0 else (cookie[:i], cookie[i + 1 :])
 
-    def get_session_cookie(self, request):
-        data, _ = self.get_cookie(request, self.session_cookie['name'])
-        return int(data) if data else 0
+    def get_cookies(self, request):
+        """Parse the security and session cookies once for the whole request.
+
+        In:
+          - ``request`` -- the web request
+
+        Return:
+          - dictionary of cookie name -> (data, path)
+        """
+        return {name: self.get_cookie(request, name) for name in self.cookie_names}
+
+    def get_security_cookie(self, request, cookies=None):
+        data, _ = self.get_cookie(request, self.security_cookie_name, cookies)
+        return data.encode('latin-1') if data else b''
+
+    def get_session_cookie(self, request, cookies=None):
+        data, _ = self.get_cookie(request, self.session_cookie_name, cookies)
+        return self.parse_id(data) if data else 0
 
     @staticmethod
-    def set_cookie(request, response, name, data, **config):
+    def get_cookie_suffix(request):
+        script_name = request.script_name.rstrip('/')
+        return f':{script_name}/'
+
+    @classmethod
+    def set_cookie(cls, request, response, name, data, suffix=None, **config):
         if name:
-            response.set_cookie(name, '{}:{}/'.format(data, request.script_name.rstrip('/')), **config)
+            response.set_cookie(name, data + (suffix or cls.get_cookie_suffix(request)), **config)
 
-    def set_security_cookie(self, request, response, secure_token):
-        self.set_cookie(request, response, data=secure_token.decode('ascii'), **self.security_cookie)
+    @staticmethod
+    def ignore_cookie(request, response, *args, **kw):
+        pass
 
-    def set_session_cookie(self, request, response, session_id):
-        self.set_cookie(request, response, data=str(session_id), **self.session_cookie)
+    def set_security_cookie(self, request, response, secure_token, suffix=None):
+        value = secure_token.decode('latin-1') + (suffix or self.get_cookie_suffix(request))
+        response.set_cookie(self.security_cookie_name, value, **self.security_cookie_params)
+
+    def set_session_cookie(self, request, response, session_id, suffix=None):
+        value = str(session_id) + (suffix or self.get_cookie_suffix(request))
+        response.set_cookie(self.session_cookie_name, value, **self.session_cookie_params)
 
     @staticmethod
     def delete_cookie(request, response, name, **config):
         if name:
             response.delete_cookie(name, **config)
 
-    def delete_security_cookie(self, request, response):
-        security_cookie_path = self.get_cookie(request, self.security_cookie['name'])[1]
-        self.delete_cookie(request, response, self.security_cookie['name'], path=security_cookie_path)
+    def delete_security_cookie(self, request, response, cookies=None):
+        security_cookie_path = self.get_cookie(request, self.security_cookie_name, cookies)[1]
+        response.delete_cookie(self.security_cookie_name, path=security_cookie_path)
+
+    def delete_session_cookie(self, request, response, cookies=None):
+        session_cookie_path = self.get_cookie(request, self.session_cookie_name, cookies)[1]
+        response.delete_cookie(self.session_cookie_name, path=session_cookie_path)
+
+    @staticmethod
+    def parse_id(value):
+        """Convert a session or state id to an integer.
+
+        In:
+          - ``value`` -- the id to convert
+
+        Return:
+          - the integer id or ``None`` if ``value`` is not a valid id
+        """
+        if not isinstance(value, str):
+            return None
+
+        # Like ``int()``, the surrounding whitespaces and a sign are accepted
+        value = value.strip()
+        digits = value[1:] if value[:1] in ('-', '+') else value
 
-    def delete_session_cookie(self, request, response):
-        session_cookie_path = self.get_cookie(request, self.session_cookie['name'])[1]
-        self.delete_cookie(request, response, self.session_cookie['name'], path=session_cookie_path)
+        # An id has at most 19 digits: longer values are rejected before ``int()`` can refuse them
+        return int(value) if (len(digits) <= 19) and digits.isdecimal() else None
 
-    def extract_state_ids(self, request):
+    def extract_state_ids(self, request, cookies=None):
         """Search the session id and the state id into the request cookies and parameters.
 
         In:
           - ``request`` -- the web request
+          - ``cookies`` -- the parsed state cookies
 
         Return:
           - session id
           - state id
         """
-        try:
-            return (
-                self.get_session_cookie(request) or int(request.params['_s']),
-                int(request.params['_c']) if self.states_history else 0,
-            )
-        except (KeyError, ValueError, TypeError):
+        session_id = self.get_session_cookie(request, cookies)
+        if session_id is None:
             return None, None
 
-    def get_state_ids(self, request):
-        session_id, state_id = self.extract_state_ids(request)
+        state_id = 0
+        if not session_id or self.states_history:
+            # Only read when needed: WebOb parses the request body to build the parameters
+            params = request.params
+            session_id = session_id or self.parse_id(params.get('_s'))
+            if self.states_history:
+                state_id = self.parse_id(params.get('_c'))
+
+        return (None, None) if (session_id is None) or (state_id is None) else (session_id, state_id)
+
+    def get_state_ids(self, request, cookies=None):
+        session_id, state_id = self.extract_state_ids(request, cookies)
 
         return (False, session_id, state_id) if session_id is not None else (True, None, None)
 
+    def check_security_token(self, request, session, secure_token):
+        """Check the secure token received against the one of the session.
+
+        In:
+          - ``request`` -- the web request
+          - ``session`` -- the session
+          - ``secure_token`` -- the secure token received from the security cookie
+
+        Return:
+          - ``None`` if the token is valid, else the ``SessionSecurityError`` to report
+        """
+        security_cookie_name = self.security_cookie_name
+        if not session.is_new and security_cookie_name and not request.is_authenticated:
+            if not secure_token:
+                return exceptions.SessionSecurityError("cookie '{}' not found".format(security_cookie_name))
+            if session.secure_token != secure_token:
+                return exceptions.SessionSecurityError("invalid token in cookie '{}'".format(security_cookie_name))
+
+        return None
+
+    def invalid_session(self, request, cookies, session_error):
+        """Build the redirection for an invalid session.
+
+        In:
+          - ``request`` -- the web request
+          - ``cookies`` -- the parsed state cookies
+          - ``session_error`` -- the ``InvalidSessionError``
+
+        Return:
+          - the redirect response, with the session cookie deleted
+        """
+        error = session_error.name() + ((': ' + session_error.args[0]) if session_error.args else '')
+        self.logger.info(error)
+
+        response = request.create_redirect_response()
+        self.delete_session_cookie(request, response, cookies)
+
+        return response
+
     @staticmethod
     def _handle_request(response, **params):
         return response
 
     def handle_request(self, chain, request, response, session_id=None, state_id=None, **params):
+        cookies = self.get_cookies(request)
+
         if (session_id is not None) and (state_id is not None):
             new_session = False
         else:
-            new_session, session_id, state_id = self.get_state_ids(request)
+            new_session, session_id, state_id = self.get_state_ids(request, cookies)
 
         use_same_state = request.is_xhr or not self.states_history
-        secure_token = self.get_security_cookie(request)
-        session = Session(self.session, new_session, secure_token, session_id, state_id, use_same_state)
+        read_only = not new_session and use_same_state and getattr(request, 'read_only_session', False)
+        secure_token = self.get_security_cookie(request, cookies)
+        session_factory = NewSession if new_session else ExistingSession
+        session = session_factory(self.session, secure_token, session_id, state_id, use_same_state, read_only)
 
         try:
-            with session.enter() as (data, callbacks):
-                security_cookie_name = self.security_cookie['name']
-                if not session.is_new and security_cookie_name and not request.is_authenticated:
-                    if not secure_token:
-                        raise exceptions.SessionSecurityError("cookie '{}' not found".format(security_cookie_name))
-                    if session.secure_token != secure_token:
-                        raise exceptions.SessionSecurityError(
-                            "invalid token in cookie '{}'".format(security_cookie_name)
-                        )
+            with session.enter() as (data, callbacks, error):
+                if error is None:
+                    error = self.check_security_token(request, session, secure_token)
+
+                if error is not None:
+                    raise self.invalid_session(request, cookies, error)
 
                 set_session(data)
 
@@ -219,12 +423,14 @@ class SessionService(plugin.Plugin):
                 )
 
                 session.is_expired = delete_session = getattr(response, 'delete_session', False)
+                session.is_modified = not getattr(response, 'session_unchanged', False)
 
                 if delete_session:
-                    self.delete_session_cookie(request, response)
+                    self.delete_session_cookie(request, response, cookies)
                 else:
-                    self.set_security_cookie(request, response, session.secure_token)
-                    self.set_session_cookie(request, response, session.session_id)
+                    suffix = self.get_cookie_suffix(request)
+                    self.set_security_cookie(request, response, session.secure_token, suffix)
+                    self.set_session_cookie(request, response, session.session_id, suffix)
 
                 use_same_state = use_same_state or not self.states_history
                 session.use_same_state = use_same_state
@@ -238,10 +444,4 @@ class SessionService(plugin.Plugin):
             raise
 
         except exceptions.InvalidSessionError as session_error:
-            error = session_error.name() + ((': ' + session_error.args[0]) if session_error.args else '')
-            self.logger.info(error)
-
-            response = request.create_redirect_response()
-            self.delete_session_cookie(request, response)
-
-            raise response
+            raise self.invalid_session(request, cookies, session_error)
@@ -12,10 +12,12 @@
 import sys
 import gzip
 import zlib
-import random
 import copyreg
+import secrets
+import weakref
+import threading
+from io import BytesIO
 from types import LambdaType, ModuleType, FunctionType
-from pickle import Pickler, Unpickler
 from marshal import dumps, loads
 from importlib import import_module
 
@@ -25,21 +27,36 @@ from nagare.server.services import SelectionService
 
 from . import serializer
 
+try:
+    from _pickle import Pickler, Unpickler
+except ImportError:
+    from pickle import Pickler, Unpickler
+
+try:
+    from types import CellType
+except ImportError:  # Python < 3.8
+
+    def CellType(value):
+        return (lambda: value).__closure__[0]
+
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
 try:
     import stackless  # noqa: F401
 except ModuleNotFoundError:
 
     def ll(module, code, defaults, closure):
-        mglobals = sys.modules[module].__dict__
-        fglobals = {k: v for k, v in mglobals.items() if not (k.startswith('__') and k.endswith('__'))}
-        fglobals['__builtins__'] = mglobals['__builtins__']
-
+        # Like any function defined in the module, the lambda shares the live module namespace
         lambda_ = LambdaType(
-            loads(code),  # noqa: S302
-            fglobals,
+            unmarshal_code(code),
+            sys.modules[module].__dict__,
             None,
             defaults,
-            closure and tuple((lambda x: lambda: x)(cell).__closure__[0] for cell in closure),
+            closure and tuple(CellType(value) for value in closure),
         )
         lambda_.__module__ = module
         return lambda_
@@ -47,30 +64,108 @@ except ModuleNotFoundError:
     def lm(module_name):
         return import_module(module_name)
 
+    marshaled_codes = {}
+
+    def marshal_code(code):
+        """Marshal a code object, only once for all the functions sharing it."""
+        key = id(code)
+        entry = marshaled_codes.get(key)
+        if entry is None:
+            # The entry is removed when the code object is collected, before its id can be reused
+            ref = weakref.ref(code, lambda _: marshaled_codes.pop(key, None))
+            entry = marshaled_codes[key] = (ref, dumps(code))
+
+        return entry[1]
+
+    # Weakly kept: a code object is forgotten once all its restored lambdas are collected, so the
+    # codes of the reloaded modules don't pile up. It is then unmarshaled again on the next fetch
+    unmarshaled_codes = weakref.WeakValueDictionary()
+
+    def unmarshal_code(marshaled_code):
+        """Unmarshal a code object, only once for all the living lambdas sharing it."""
+        code = unmarshaled_codes.get(marshaled_code)
+        if code is None:
+            code = unmarshaled_codes[marshaled_code] = loads(marshaled_code)  # noqa: S302
+
+            # The restored lambdas are stored back without marshaling their code again
+            key = id(code)
+            ref = weakref.ref(code, lambda _: marshaled_codes.pop(key, None))
+            marshaled_codes[key] = (ref, marshaled_code)
+
+        return code
+
     class Pickler(Pickler):
         def reducer_override(self, obj):
-            if (getattr(obj, '__name__', '') == '<lambda>') or (
-                isinstance(obj, FunctionType) and ('.<locals>.' in obj.__qualname__)
-            ):
-                return ll, (
-                    obj.__module__,
-                    dumps(obj.__code__),
-                    obj.__defaults__,
-                    obj.__closure__ and [cell.cell_contents for cell in obj.__closure__],
-                )
-
-            return NotImplemented
+            # Called for every object of the graph: reject the non functions with a single type check
+            if type(obj) is not FunctionType:
+                return NotImplemented
+
+            if (obj.__name__ != '<lambda>') and ('.<locals>.' not in obj.__qualname__):
+                return NotImplemented
+
+            return ll, (
+                obj.__module__,
+                marshal_code(obj.__code__),
+                obj.__defaults__,
+                obj.__closure__ and [cell.cell_contents for cell in obj.__closure__],
+            )
 
     copyreg.pickle(ModuleType, lambda m: (lm, (m.__name__,)))
 
 
+# Session ids are 63 bits integers, fitting into a signed 64 bits column, with 62 random bits.
+# Their highest bit is set, so they are never null and always have 19 digits
+ID_BASE = 1 << 62
+ID_RANGE = 1 << 62
+
+_references = {}
+
+
+def resolve_reference(ref):
+    """Load the object designated by a reference string, only once per reference."""
+    if not isinstance(ref, str):
+        return ref
+
+    o = _references.get(ref)
+    if o is None:
+        o = _references[ref] = reference.load_object(ref)[0]
+
+    return o
+
+
+def is_streaming(serializer):
+    """Can the ``dumps()`` method of a serializer write the state data into a given file?
+
+    The ``STREAMING`` flag must be declared by the class defining ``dumps()``: a ``dumps()``
+    overridden in a subclass doesn't inherit the capacity.
+    """
+    for cls in type(serializer).__mro__:
+        if 'dumps' in vars(cls):
+            return vars(cls).get('STREAMING', False)
+
+    return False
+
+
 class Unpickler(Unpickler):  # In Python>=3.13, the `persistent_load()` method can only be changed in a derivated class
     pass
 
 
 class Compressor(object):
+    # Below this size, the compression headers outweigh the gain
+    MIN_COMPRESSIBLE_SIZE = 256
+
+    # Incremental compression context factory, ``None`` if the streamed compression is not supported
+    compressobj = None
+
+    @classmethod
+    def check_dependencies(cls):
+        """Raise an ``ImportError`` if a package the compressor needs is missing."""
+
     @classmethod
     def compress(cls, data):
+        if len(data) < cls.MIN_COMPRESSIBLE_SIZE:
+            return data
+
         compressed_data = cls._compress(data)
         return compressed_data if len(compressed_data) < len(data) else data
 
@@ -95,18 +190,124 @@ class GZipCompressor(Compressor):
     _compress = gzip.compress
     _decompress = gzip.decompress
 
+    @staticmethod
+    def compressobj():
+        # Same format and compression level than ``gzip.compress()``
+        return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
     @staticmethod
     def is_compressed(data):
-        return data and (data[0] == 0o37) and (data[1] == 0o213)
+        return data[:2] == b'\x1f\x8b'
 
 
 class ZLibCompressor(Compressor):
     _compress = zlib.compress
     _decompress = zlib.decompress
+    compressobj = zlib.compressobj
+
+    # Headers of the 4 compression levels, without preset dictionary, the default one first
+    HEADERS = (b'\x78\x9c', b'\x78\x01', b'\x78\x5e', b'\x78\xda')
+
+    @classmethod
+    def is_compressed(cls, data):
+        return data[:2] in cls.HEADERS
+
+
+class ZstdCompressor(Compressor):
+    """Zstandard compression, requires the ``zstandard`` package."""
+
+    # The (de)compression contexts are costly to create and can't be shared between threads
+    contexts = threading.local()
+
+    @classmethod
+    def check_dependencies(cls):
+        if zstandard is None:
+            raise ImportError(
+                "the 'zstandard' package is required by the zstd compressor, "
+                "install the 'zstd' extra: pip install 'nagare-services-sessions[zstd]'"
+            )
+
+    @classmethod
+    def get_compressor(cls):
+        compressor = getattr(cls.contexts, 'compressor', None)
+        if compressor is None:
+            compressor = cls.contexts.compressor = zstandard.ZstdCompressor(level=3)
+
+        return compressor
+
+    @classmethod
+    def _compress(cls, data):
+        return cls.get_compressor().compress(data)
+
+    @classmethod
+    def _decompress(cls, data):
+        decompressor = getattr(cls.contexts, 'decompressor', None)
+        if decompressor is None:
+            decompressor = cls.contexts.decompressor = zstandard.ZstdDecompressor()
+
+        # The streamed frames don't record the content size ``decompress()`` requires
+        return decompressor.decompressobj().decompress(data)
+
+    @classmethod
+    def compressobj(cls):
+        return cls.get_compressor().compressobj()
 
     @staticmethod
     def is_compressed(data):
-        return data and (data[0] == 0x78) and ((data[0] * 256 + data[1]) % 31 == 0)
+        return data[:4] == b'\x28\xb5\x2f\xfd'
+
+
+class CompressedFile(object):
+    """A write-only file, compressing on the fly what is written once a threshold is reached.
+
+    The pickler writes directly into it so, for the big states, the uncompressed
+    stream is never completely kept in memory.
+    """
+
+    def __init__(self, compressor, threshold):
+        """Initialization.
+
+        In:
+          - ``compressor`` -- the compressor, with an incremental compression context factory
+          - ``threshold`` -- data are compressed once this number of bytes is written
+        """
+        self.compressor = compressor
+        self.threshold = max(threshold, compressor.MIN_COMPRESSIBLE_SIZE)
+        self.buffer = BytesIO()
+        self.context = None
+        self.size = 0
+        self.compressed = False
+
+    def write(self, data):
+        self.size += len(data)
+
+        if self.context is not None:
+            self.buffer.write(self.context.compress(data))
+        else:
+            self.buffer.write(data)
+            if self.size > self.threshold:
+                self.start_compression()
+
+        return len(data)
+
+    def start_compression(self):
+        self.context = self.compressor.compressobj()
+        self.compressed = True
+
+        # A view on the buffered bytes, released before the buffer is replaced
+        with self.buffer.getbuffer() as data:
+            compressed_data = self.context.compress(data)
+
+        self.buffer = BytesIO()
+        self.buffer.write(compressed_data)
+
+    def getvalue(self):
+        """Terminate the compression and return the written data."""
+        if self.context is not None:
+            self.buffer.write(self.context.flush())
+            self.context = None
+
+        return self.buffer.getvalue()
 
 
 class Sessions(plugin.Plugin):
@@ -159,17 +360,29 @@ class Sessions(plugin.Plugin):
         publisher = publisher_service.service
         self.check_concurrence(publisher.has_multi_processes, publisher.has_multi_threads)
 
-        pickler = reference.load_object(pickler)[0] if isinstance(pickler, str) else pickler
-        unpickler = reference.load_object(unpickler)[0] if isinstance(unpickler, str) else unpickler
-        serializer = reference.load_object(serializer)[0] if isinstance(serializer, str) else serializer
+        pickler = resolve_reference(pickler)
+        unpickler = resolve_reference(unpickler)
+        serializer = resolve_reference(serializer)
         self.serializer = serializer(pickler, unpickler, debug, self.logger)
         self.debug = debug
-        self.compressor = reference.load_object(compressor)[0] if isinstance(compressor, str) else compressor
+        self.compressor = resolve_reference(compressor)
+        # Custom compressors only have to provide ``compress()`` and ``decompress()``
+        check_dependencies = getattr(self.compressor, 'check_dependencies', None)
+        if check_dependencies is not None:
+            check_dependencies()
+        # Bound once, the state path doesn't look them up through the compressor class on each request
+        self.compress = self.compressor.compress
+        self.decompress = self.compressor.decompress
         self.min_compress_len = min_compress_len
+        self.stream_compression = bool(
+            min_compress_len
+            and is_streaming(self.serializer)
+            and (getattr(self.compressor, 'compressobj', None) is not None)
+        )
 
     @staticmethod
     def generate_id():
-        return random.randint(1000000000000000, 9999999999999999)
+        return ID_BASE + secrets.randbelow(ID_RANGE)
 
     def handle_start(self, app):
         pass
@@ -184,14 +397,11 @@ class Sessions(plugin.Plugin):
         self.serializer.dispatch_table = dispatch_table
 
     def generate_secure_token(self):
-        return b'%d' % self.generate_id()
+        return secrets.token_hex(16).encode('ascii')
 
     def generate_session_id(self):
-        session_id = self.generate_id()
-        while self.check_session_id(session_id):
-            session_id = self.generate_id()
-
-        return session_id
+        # With 62 random bits, a collision with an existing session is too unlikely to be checked
+        return self.generate_id()
 
     def create(self, secure_token):
         """Create a new session.
@@ -217,8 +427,78 @@ class Sessions(plugin.Plugin):
           - objects graph
         """
         self.logger.debug('fetching session {} - state {}'.format(session_id, state_id))
-        new_state_id, secure_token, session_data, state_data = self._fetch(session_id, state_id)
-        return (new_state_id, secure_token, self.serializer.loads(session_data, self.compressor.decompress(state_data)))
+        return self.deserialize(*self._fetch(session_id, state_id))
+
+    def lock_and_fetch(self, lock, session_id, state_id):
+        """Acquire the lock of a session and retrieve a serialized state.
+
+        In:
+          - ``lock`` -- the lock of the session
+          - ``session_id`` -- session id of this state
+          - ``state_id`` -- id of this state
+
+        Return:
+          - lock status
+          - the serialized state, to be given to ``deserialize()`` (``None`` if the lock wasn't acquired)
+        """
+        self.logger.debug('locking and fetching session {} - state {}'.format(session_id, state_id))
+        return self._lock_and_fetch(lock, session_id, state_id)
+
+    def deserialize(self, new_state_id, secure_token, session_data, state_data):
+        """Deserialize a state.
+
+        In:
+          - ``new_state_id`` -- id of the latest state
+          - ``secure_token`` -- secure number associated to the session
+          - ``session_data`` -- data kept into the session
+          - ``state_data`` -- data kept into the state
+
+        Return:
+          - id of the latest state
+          - secure number associated to the session
+          - objects graph
+        """
+        return new_state_id, secure_token, self.serializer.loads(session_data, self.decompress(state_data))
+
+    def serialize(self, session_id, state_id, use_same_state, data):
+        """Serialize and compress a state.
+
+        In:
+          - ``session_id`` -- session id of this state
+          - ``state_id`` -- id of this state
+          - ``use_same_state`` -- is a copy of this state to be created?
+          - ``data`` -- the objects graph
+
+        Return:
+          - data to keep into the session
+          - data to keep into the state
+        """
+        self.logger.debug('storing session %s - state %s', session_id, state_id)
+
+        if self.stream_compression:
+            # The state is compressed while pickled
+            state_file = CompressedFile(self.compressor, self.min_compress_len)
+            session_data, state_data = self.serializer.dumps(data, not use_same_state, state_file)
+            state_data_len = state_file.size
+            compressed = state_file.compressed
+        else:
+            session_data, state_data = self.serializer.dumps(data, not use_same_state)
+            state_data_len = len(state_data)
+            compressed = self.min_compress_len and state_data_len > self.min_compress_len
+            if compressed:
+                state_data = self.compress(state_data)
+
+        if compressed and self.debug:
+            self.logger.debug(
+                '%d -> %d state bytes (compression %d%%) for session %s - state %s',
+                state_data_len,
+                len(state_data),
+                100 - (len(state_data) * 100 // state_data_len),
+                session_id,
+                state_id,
+            )
+
+        return session_data, state_data
 
     def store(self, session_id, state_id, secure_token, use_same_state, data):
         """Store the state.
@@ -230,41 +510,28 @@ class Sessions(plugin.Plugin):
           - ``use_same_state`` -- is a copy of this state to be created?
           - ``data`` -- the objects graph
         """
-        self.logger.debug('storing session %s - state %s', session_id, state_id)
+        session_data, state_data = self.serialize(session_id, state_id, use_same_state, data)
+        self._store(session_id, state_id, secure_token, use_same_state, session_data, state_data)
 
-        session_data, state_data = self.serializer.dumps(data, not use_same_state)
-        state_data_len = len(state_data)
-        if self.min_compress_len and state_data_len > self.min_compress_len:
-            state_data = self.compressor.compress(state_data)
-            if self.debug:
-                self.logger.debug(
-                    '%d -> %d state bytes (compression %d%%) for session %s - state %s',
-                    state_data_len,
-                    len(state_data),
-                    100 - (len(state_data) * 100 // state_data_len),
-                    session_id,
-                    state_id,
-                )
+    def store_and_release(self, lock, session_id, state_id, secure_token, use_same_state, data):
+        """Store the state and release the lock of the session.
 
-        self._store(session_id, state_id, secure_token, use_same_state, session_data, state_data)
+        In:
+          - ``lock`` -- the acquired lock of the session
+          - ``session_id`` -- session id of this state
+          - ``state_id`` -- id of this state
+          - ``secure_id`` -- the secure number associated to the session
+          - ``use_same_state`` -- is a copy of this state to be created?
+          - ``data`` -- the objects graph
+        """
+        session_data, state_data = self.serialize(session_id, state_id, use_same_state, data)
+        self._store_and_release(lock, session_id, state_id, secure_token, use_same_state, session_data, state_data)
 
     # -------------------------------------------------------------------------
 
     def check_concurrence(self, multi_processes, multi_threads):
         raise NotImplementedError()
 
-    @staticmethod
-    def check_session_id(session_id):
-        """Test if a session exist.
-
-        In:
-          - ``session_id`` -- id of a session
-
-        Return:
-          - is ``session_id`` the id of an existing session?
-        """
-        raise NotImplementedError()
-
     def create_lock(self, session_id):
         """Create a new lock for a session.
 
@@ -320,6 +587,31 @@ class Sessions(plugin.Plugin):
         """
         raise NotImplementedError()
 
+    def _lock_and_fetch(self, lock, session_id, state_id):
+        """Acquire the lock of a session and retrieve a state with its associated objects graph.
+
+        A backend able to acquire the lock and read the state in a single round-trip (i.e a script)
+        can override this method. The lock must be left acquired on success and released on error.
+
+        In:
+          - ``lock`` -- the lock of the session
+          - ``session_id`` -- session id of this state
+          - ``state_id`` -- id of this state
+
+        Return:
+          - lock status
+          - tuple (id of the more recent stored state, secure number associated to the session,
+            data kept into the session, data kept into the state) or ``None`` if the lock wasn't acquired
+        """
+        if not lock.__enter__():
+            return False, None
+
+        try:
+            return True, self._fetch(session_id, state_id)
+        except BaseException:
+            lock.__exit__(*sys.exc_info())
+            raise
+
     def _store(self, session_id, state_id, secure_id, use_same_state, session_data, state_data):
         """Store a state and its associated objects graph.
 
@@ -333,6 +625,25 @@ class Sessions(plugin.Plugin):
         """
         raise NotImplementedError()
 
+    def _store_and_release(self, lock, session_id, state_id, secure_id, use_same_state, session_data, state_data):
+        """Store a state and its associated objects graph, then release the lock of the session.
+
+        A backend able to send the write and the lock release in a single round-trip (i.e a pipeline)
+        can override this method. The exit of the lock context must then become a no-op.
+
+        By default the state is only stored, the lock being released on exit of its context.
+
+        In:
+          - ``lock`` -- the acquired lock of the session
+          - ``session_id`` -- session id of this state
+          - ``state_id`` -- id of this state
+          - ``secure_id`` -- the secure number associated to the session
+          - ``use_same_state`` -- is this state to be stored in the previous snapshot?
+          - ``session_data`` -- data to keep into the session
+          - ``state_data`` -- data to keep into the state
+        """
+        self._store(session_id, state_id, secure_id, use_same_state, session_data, state_data)
+
 
 class SessionsSelection(SelectionService):
     ENTRY_POINTS = 'nagare.sessions'
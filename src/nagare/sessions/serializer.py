@@ -7,22 +7,12 @@
 # this distribution.
 # --
 
-import sys
-
-try:
-    import copy_reg as copyreg
-except ImportError:
-    import copyreg
-
-try:
-    from cStringIO import StringIO as BuffIO
-except ImportError:
-    from io import BytesIO as BuffIO
+import pickle
+import copyreg
+from io import BytesIO as BuffIO
 
 from .exceptions import StateError
 
-PY2 = sys.version_info.major == 2
-
 
 class DummyFile(object):
     """A write-only file that does nothing."""
@@ -31,6 +21,16 @@ class DummyFile(object):
         pass
 
 
+def no_persistent_id(o):
+    """Persistent id hook that lets all the objects be pickled."""
+    return None
+
+
+def no_reducers(clean_callbacks, result):
+    """Default dispatch table: no additional reducers."""
+    return {}
+
+
 class Result(object):
     def __init__(self):
         self.session_data = {}
@@ -40,18 +40,23 @@ class Result(object):
 
 
 class Dummy(object):
-    def __init__(self, pickler, unpickler, debug, logger):
+    # Can the state data be written into a file given to ``dumps()``?
+    STREAMING = False
+
+    def __init__(self, pickler, unpickler, debug, logger, protocol=pickle.HIGHEST_PROTOCOL):
         """Initialization.
 
         - ``pickler`` -- pickler to use
         - ``unpickler`` -- unpickler to use
+        - ``protocol`` -- pickle protocol to use
         """
         self.pickler = pickler
         self.unpickler = unpickler
+        self.protocol = protocol
         self.debug = debug
         self.logger = logger
         self.persistent_id = None
-        self.dispatch_table = lambda *args: {}
+        self.dispatch_table = no_reducers
 
     def _dumps(self, pickler, data, clean_callbacks):
         """Serialize an objects graph.
@@ -68,19 +73,14 @@ class Dummy(object):
         result = Result()
 
         # Serialize the objects graph and extract all the callbacks
-        def persistent_id(o):
-            return self.persistent_id(o, clean_callbacks, result)
-
-        if PY2:
-            if self.persistent_id:
-                pickler.inst_persistent_id = persistent_id
-        else:
-            if self.persistent_id:
-                pickler.persistent_id = persistent_id
+        persistent_id = self.persistent_id
+        if persistent_id:
+            pickler.persistent_id = lambda o: persistent_id(o, clean_callbacks, result)
 
-            dispatch_table = copyreg.dispatch_table.copy()
-            dispatch_table.update(self.dispatch_table(clean_callbacks, result))
-            pickler.dispatch_table = dispatch_table
+        reducers = self.dispatch_table(clean_callbacks, result)
+        # A merged dict, looked up from C by the pickler, is faster than a ChainMap.
+        # Without reducers, the global table is shared: the pickler only reads its dispatch table
+        pickler.dispatch_table = {**copyreg.dispatch_table, **reducers} if reducers else copyreg.dispatch_table
 
         pickler.dump(data)
 
@@ -97,7 +97,11 @@ class Dummy(object):
           - data kept into the session
           - data kept into the state
         """
-        pickler = self.pickler(DummyFile(), protocol=-1)
+        if not self.persistent_id and (self.dispatch_table is no_reducers):
+            # No hook to collect anything from the objects graph: the pickling pass would have no effect
+            return None, (data, {})
+
+        pickler = self.pickler(DummyFile(), protocol=self.protocol)
         session_data, components, callbacks, tasklets = self._dumps(pickler, data, clean_callbacks)
 
         # This dummy serializer returns the data untouched
@@ -118,28 +122,40 @@ class Dummy(object):
 
 
 class Pickle(Dummy):
-    def dumps(self, data, clean_callbacks):
+    STREAMING = True
+
+    def __init__(self, pickler, unpickler, debug, logger, protocol=pickle.HIGHEST_PROTOCOL):
+        """Initialization.
+
+        - ``pickler`` -- pickler to use
+        - ``unpickler`` -- unpickler to use
+        - ``protocol`` -- pickle protocol to use
+        """
+        super(Pickle, self).__init__(pickler, unpickler, debug, logger, protocol)
+
+        # Most of the states have no session data: their pickle is computed once
+        self.empty_session_data = pickle.dumps({}, protocol=protocol)
+
+    def dumps(self, data, clean_callbacks, state_file=None):
         """Serialize an objects graph.
 
         In:
           - ``data`` -- the objects graph
           - ``clean_callbacks`` -- do we have to forget the old callbacks?
+          - ``state_file`` -- file where to write the state data (a new buffer if ``None``)
 
         Out:
           - data kept into the session
           - data kept into the state
         """
-        f = BuffIO()
-        pickler = self.pickler(f, protocol=-1)
+        f = BuffIO() if state_file is None else state_file
+        pickler = self.pickler(f, protocol=self.protocol)
 
         # Pickle the data
         session_data, components, callbacks, tasklets = self._dumps(pickler, data, clean_callbacks)
 
         # Pickle the callbacks
-        if PY2:
-            pickler.inst_persistent_id = lambda o: None
-        else:
-            pickler.persistent_id = lambda o: None
+        pickler.persistent_id = no_persistent_id
         pickler.dump(callbacks)
 
         # Kill all the blocked tasklets, which are now serialized
@@ -149,9 +165,17 @@ class Pickle(Dummy):
         # The pickled data are returned
         state_data = f.getvalue()
 
-        f = BuffIO()
-        self.pickler(f, protocol=-1).dump(session_data)
-        session_data = f.getvalue()
+        if session_data:
+            if state_file is None:
+                # Reuse the buffer of the state data
+                f.seek(0)
+                f.truncate()
+            else:
+                f = BuffIO()
+            self.pickler(f, protocol=self.protocol).dump(session_data)
+            session_data = f.getvalue()
+        else:
+            session_data = self.empty_session_data
 
         if self.debug:
             if components:
@@ -180,9 +204,10 @@ class Pickle(Dummy):
           - the callbacks
         """
         p = self.unpickler(BuffIO(state_data))
-        if session_data:
-            session_data = self.unpickler(BuffIO(session_data)).load()
-            p.persistent_load = lambda i: session_data.get(int(i))
+        if session_data and (session_data != self.empty_session_data):
+            # The persistent ids can be given as strings by the ``persistent_id`` hook
+            get_session_data = self.unpickler(BuffIO(session_data)).load().get
+            p.persistent_load = lambda i: get_session_data(int(i))
 
         try:
             return p.load(), p.load()
@@ -0,0 +1,150 @@
+# --
+# Copyright (c) 2008-2024 Net-ng.
+# All rights reserved.
+#
+# This software is licensed under the BSD License, as described in
+# the file LICENSE.txt, which you should have received as part of
+# this distribution.
+# --
+
+import pytest
+
+from nagare.services import http_session
+from nagare.sessions import exceptions
+
+COOKIE = {
+    'max_age': None,
+    'path': '/',
+    'domain': None,
+    'secure': False,
+    'httponly': True,
+    'comment': None,
+    'overwrite': False,
+    'samesite': 'lax',
+}
+
+
+class Service(object):
+    def __init__(self, service):
+        self.service = service
+
+
+class Lock(object):
+    def __init__(self):
+        self.entered = self.exited = 0
+
+    def __enter__(self):
+        self.entered += 1
+        return True
+
+    def __exit__(self, *args):
+        self.exited += 1
+
+
+class Sessions(object):
+    def __init__(self, error=None):
+        self.lock = Lock()
+        self.error = error
+        self.stored = self.deleted = False
+
+    def get_lock(self, session_id):
+        return self.lock
+
+    def fetch(self, session_id, state_id):
+        if self.error is not None:
+            raise self.error
+
+        return state_id, b'token', ({}, {})
+
+    def lock_and_fetch(self, lock, session_id, state_id):
+        status = lock.__enter__()
+        if self.error is not None:
+            # Like ``Sessions._lock_and_fetch()``, the lock is released on error
+            lock.__exit__(None, None, None)
+            raise self.error
+
+        return status, (state_id, b'token', None, None)
+
+    @staticmethod
+    def deserialize(new_state_id, secure_token, session_data, state_data):
+        return new_state_id, secure_token, ({}, {})
+
+    def store_and_release(self, lock, session_id, state_id, secure_token, use_same_state, data):
+        self.stored = True
+
+    def delete(self, session_id):
+        self.deleted = True
+
+
+class Request(object):
+    def __init__(self, cookies=None, params=None):
+        self.cookies = cookies or {}
+        self.params = params or {}
+        self.script_name = '/app'
+
+
+def create_service(states_history=True, sessions=None):
+    return http_session.SessionService(
+        'sessions',
+        None,
+        states_history,
+        dict(COOKIE, name='nagare-session'),
+        dict(COOKIE, name='nagare-token'),
+        Service(sessions),
+        None,
+    )
+
+
+@pytest.mark.parametrize(
+    'value, id_', [('12', 12), ('-12', -12), ('+12', 12), (' 12 ', 12), ('9223372036854775807', 2**63 - 1)]
+)
+def test_parse_valid_id(value, id_):
+    assert http_session.SessionService.parse_id(value) == id_
+
+
+@pytest.mark.parametrize('value', [None, '', '-', 'abc', '1.2', '1' * 20, '9' * 5000, '-' + '9' * 5000])
+def test_parse_invalid_id(value):
+    assert http_session.SessionService.parse_id(value) is None
+
+
+def test_extract_too_long_ids():
+    service = create_service()
+    too_long = '9' * 5000
+
+    request = Request(cookies={'nagare-session': too_long + ':/app/'}, params={'_c': '1'})
+    assert service.extract_state_ids(request) == (None, None)
+
+    request = Request(params={'_s': too_long, '_c': '1'})
+    assert service.extract_state_ids(request) == (None, None)
+
+    request = Request(params={'_s': '12', '_c': too_long})
+    assert service.extract_state_ids(request) == (None, None)
+
+    request = Request(params={'_s': '12', '_c': '1'})
+    assert service.extract_state_ids(request) == (12, 1)
+
+
+@pytest.mark.parametrize('read_only', [False, True])
+def test_expired_session_reported(read_only):
+    sessions = Sessions(exceptions.ExpirationError('session expired'))
+    session = http_session.ExistingSession(sessions, b'token', 12, 1, True, read_only)
+
+    with session.enter() as (data, callbacks, error):
+        assert isinstance(error, exceptions.ExpirationError)
+        assert data is callbacks is None
+
+    assert sessions.lock.entered == sessions.lock.exited == (0 if read_only else 1)
+    assert not sessions.stored
+
+
+@pytest.mark.parametrize('read_only', [False, True])
+def test_delete_session_locked(read_only):
+    sessions = Sessions()
+    session = http_session.ExistingSession(sessions, b'token', 12, 1, True, read_only)
+
+    with session.enter():
+        session.is_expired = True
+        assert sessions.lock.entered == (0 if read_only else 1)
+
+    assert sessions.deleted
+    assert sessions.lock.entered == sessions.lock.exited == 1